@@ -1,4 +1,7 @@
 # standard library imports
+import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 # package imports
 import numpy as np
@@ -9,12 +12,32 @@ import tensorflow as tf
 import tensorflow_probability as tfp
 
 # local imports
+import bnn.util as util
 
-def hmc_tf(unnormalized_log_prob, init_values, num_results = int(10e3), num_burnin_steps = int(1e3), num_leapfrog_steps=3, step_size=1.):
+def momentum_from_precision(precision, n_hyper=0):
+    '''
+    Momentum distribution N(0, precision) for a (K, 1) weight state, i.e. uses precision as the HMC mass matrix.
+    Any scalar hyperparameters in the state (n_hyper of them, after the weights) get unit normal momentum.
+    '''
+    K = precision.shape[0]
+    dtype = precision.dtype
+    momentum_w = tfp.distributions.TransformedDistribution(
+        tfp.distributions.MultivariateNormalTriL(loc=tf.zeros(K, dtype=dtype), scale_tril=tf.linalg.cholesky(precision)),
+        tfp.bijectors.Reshape(event_shape_out=[K,1], event_shape_in=[K]))
+
+    if n_hyper == 0:
+        return momentum_w
+    
+    momentum_hyper = [tfp.distributions.Normal(tf.constant(0., dtype=dtype), tf.constant(1., dtype=dtype)) for _ in range(n_hyper)]
+    return tfp.distributions.JointDistributionSequential([momentum_w] + momentum_hyper)
+
+def hmc_tf(unnormalized_log_prob, init_values, num_results = int(10e3), num_burnin_steps = int(1e3), num_leapfrog_steps=3, step_size=1., momentum_distribution=None, sampler='hmc'):
     '''
     Inputs:
         unnormalized_log_prob: python callable (tensor inputs and outputs)
-        init_values: initial parameter values (numpy array)
+        init_values: initial parameter values (tensor or list of tensors; numpy is converted)
+        momentum_distribution: optional momentum distribution for preconditioned HMC (see momentum_from_precision)
+        sampler: 'hmc' (fixed num_leapfrog_steps) or 'nuts' (trajectory length chosen per step, dual averaging step size)
         [various optional hmc arguments]
     Outputs:
         samples: posterior samples (numpy array)
@@ -22,12 +45,40 @@ def hmc_tf(unnormalized_log_prob, init_values, num_results = int(10e3), num_burn
     '''
 
     # Run HMC
-    adaptive_hmc = tfp.mcmc.SimpleStepSizeAdaptation(
-        tfp.mcmc.HamiltonianMonteCarlo(
-            target_log_prob_fn=unnormalized_log_prob,
-            num_leapfrog_steps=3,
-            step_size=1.),
-        num_adaptation_steps=int(num_burnin_steps * 0.8))
+    if sampler == 'hmc':
+        if momentum_distribution is None:
+            hmc = tfp.mcmc.HamiltonianMonteCarlo(
+                target_log_prob_fn=unnormalized_log_prob,
+                num_leapfrog_steps=num_leapfrog_steps,
+                step_size=step_size)
+        else:
+            hmc = tfp.experimental.mcmc.PreconditionedHamiltonianMonteCarlo(
+                target_log_prob_fn=unnormalized_log_prob,
+                momentum_distribution=momentum_distribution,
+                num_leapfrog_steps=num_leapfrog_steps,
+                step_size=step_size)
+
+        adaptive_hmc = tfp.mcmc.SimpleStepSizeAdaptation(
+            hmc,
+            num_adaptation_steps=int(num_burnin_steps * 0.8))
+
+    elif sampler == 'nuts':
+        if momentum_distribution is None:
+            nuts = tfp.mcmc.NoUTurnSampler(
+                target_log_prob_fn=unnormalized_log_prob,
+                step_size=step_size)
+        else:
+            nuts = tfp.experimental.mcmc.PreconditionedNoUTurnSampler(
+                target_log_prob_fn=unnormalized_log_prob,
+                momentum_distribution=momentum_distribution,
+                step_size=step_size)
+
+        adaptive_hmc = tfp.mcmc.DualAveragingStepSizeAdaptation(
+            nuts,
+            num_adaptation_steps=int(num_burnin_steps * 0.8))
+
+    else:
+        raise ValueError('sampler must be \'hmc\' or \'nuts\'')
 
     if isinstance(init_values, list):
         init_values_tf = [tf.convert_to_tensor(v) for v in init_values]
@@ -35,13 +86,14 @@ def hmc_tf(unnormalized_log_prob, init_values, num_results = int(10e3), num_burn
         init_values_tf = tf.convert_to_tensor(init_values)
 
     # Run the chain (with burn-in).
-    @tf.function
-    def run_chain():
+    # whole chain is XLA-compiled; num_results and num_burnin_steps are python ints so they are baked into the graph
+    @tf.function(jit_compile=True)
+    def run_chain(current_state):
         # Run the chain (with burn-in).
         samples, is_accepted = tfp.mcmc.sample_chain(
               num_results=num_results,
               num_burnin_steps=num_burnin_steps,
-              current_state=init_values_tf,
+              current_state=current_state,
               kernel=adaptive_hmc,
               seed=1,
               trace_fn=lambda _, pkr: pkr.inner_results.is_accepted)
@@ -58,7 +110,7 @@ def hmc_tf(unnormalized_log_prob, init_values, num_results = int(10e3), num_burn
         
         return sample_mean, sample_stddev, is_accepted, samples
 
-    sample_mean, sample_stddev, is_accepted, samples = run_chain()
+    sample_mean, sample_stddev, is_accepted, samples = run_chain(init_values_tf)
 
     # convert to numpy for output
     if isinstance(samples, list):
@@ -123,7 +175,7 @@ class ModelTrainer(object):
         for epoch in range(1, n_epochs+1):
 
             for i in range(n_rep_opt):
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
                 loss, metrics = self.model.loss(x, y, **kwargs_loss)
 
@@ -155,34 +207,77 @@ class ModelTrainer(object):
 
 
 
-def train(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n_rep_opt=10, print_freq=None, frac_start_save=1, frac_lookback=0.5, path_checkpoint='./'):
+def _end_epoch(fixed_point_step, model, x, y, epoch, n_epochs, print_freq):
+    '''
+    Per-epoch updates shared by train and train_score: fixed point updates (fixed_point_step), then printing every print_freq epochs
+    '''
+    with torch.no_grad():
+        fixed_point_step()
+
+        if print_freq is not None:
+            if (epoch + 1) % print_freq == 0:
+                model.print_state(x, y, epoch+1, n_epochs)
+
+
+def train(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n_rep_opt=10, print_freq=None, frac_start_save=1, frac_lookback=0.5, path_checkpoint='./', grad_tol=None, use_compile=False):
     '''
     frac_lookback will only result in reloading early stopped model if frac_lookback < 1 - frac_start_save
+    grad_tol: if not None, stop the n_rep_opt inner steps early once the gradient norm drops below grad_tol
+    use_compile: if True, wrap the loss and fixed point updates in torch.compile (needs torch >= 2.0 and a working compiler toolchain)
     '''
 
-    loss = torch.zeros(n_epochs)
-    loss_best = torch.tensor(float('inf'))
-    loss_best_saved = torch.tensor(float('inf'))
+    loss = np.zeros(n_epochs, dtype=np.float32) # kept on cpu so convergence checks don't sync with the device
+    loss_best = float('inf')
+    loss_best_saved = float('inf')
     saved_model = False
     model.precompute(x, x_linear)
 
+    # temperature is passed as a tensor (updated in place) so changing it doesn't trigger recompilation
+    temperature_t = torch.tensor(1.0)
+    loss_step = lambda: model.loss(x, y, x_linear=x_linear, temperature=temperature_t)
+    fixed_point_step = lambda: model.fixed_point_updates(x, y, x_linear=x_linear, temperature=1)
+    if use_compile:
+        loss_step = torch.compile(loss_step, dynamic=False)
+        fixed_point_step = torch.compile(fixed_point_step, dynamic=False)
+
+    # loop invariants
+    params = [p for p in model.parameters() if p.requires_grad]
+    ckpt_path = os.path.join(path_checkpoint, 'checkpoint.tar')
+    warmup_epochs = n_epochs/10
+    start_save_epoch = frac_start_save*n_epochs
+    lookback = .25*n_epochs # lookback is 25% of samples by default
+
+    # (epoch, loss) pairs with increasing loss, front is the min over the lookback window
+    window_min = collections.deque()
+
+    # checkpoints are written by a background thread (single worker, so saves land in order)
+    io_exec = ThreadPoolExecutor(max_workers=1)
+    save_future = None
+    staged = None # cpu snapshot of the model, reused between saves
+
     for epoch in range(n_epochs):
 
         # TEMPERATURE HARDECODED, NEED TO FIX
         #temperature_kl = 0. if epoch < n_epochs/2 else 1.0
         #temperature_kl = epoch / (n_epochs/2) if epoch < n_epochs/2 else 1.0
-        temperature_kl = epoch / (n_epochs/10) if epoch < n_epochs/10 else 1.0
+        temperature_kl = epoch / warmup_epochs if epoch < warmup_epochs else 1.0
         #temperature_kl = 0. # SET TO ZERO TO IGNORE KL
+        temperature_t.fill_(temperature_kl)
 
         for i in range(n_rep_opt):
 
-            l = model.loss(x, y, x_linear=x_linear, temperature=temperature_kl)
+            l = loss_step()
 
             # backward
-            optimizer.zero_grad()
-            l.backward(retain_graph=True)
+            optimizer.zero_grad(set_to_none=True)
+            l.backward()
             optimizer.step()
 
+            if grad_tol is not None:
+                grad_norm = torch.sqrt(sum(p.grad.detach().pow(2).sum() for p in params if p.grad is not None)).item()
+                if grad_norm < grad_tol:
+                    break
+
             ##
             #print('------------- %d -------------' % epoch)
             #print('s     :', model.layer_in.s_loc.data)
@@ -198,55 +293,70 @@ def train(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n_rep_o
 
         loss[epoch] = l.item()
 
-        with torch.no_grad():
-            model.fixed_point_updates(x, y, x_linear=x_linear, temperature=1)
-
-        # print state
-        if print_freq is not None:
-            if (epoch + 1) % print_freq == 0:
-                model.print_state(x, y, epoch+1, n_epochs)
+        _end_epoch(fixed_point_step, model, x, y, epoch, n_epochs, print_freq)
 
         # see if improvement made (only used if KL isn't tempered)
         if loss[epoch] < loss_best and temperature_kl==1.0:
             loss_best = loss[epoch]
 
         # save model
-        if epoch > frac_start_save*n_epochs and loss[epoch] < loss_best_saved:
+        if epoch > start_save_epoch and loss[epoch] < loss_best_saved:
             print('saving mode at epoch = %d' % epoch)
             saved_model = True
             loss_best_saved = loss[epoch]
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'loss': loss[epoch],
-            },  os.path.join(path_checkpoint, 'checkpoint.tar'))
+            save_future, staged = util.training.checkpoint_async(io_exec, save_future, staged, model, optimizer, epoch, float(loss[epoch]), ckpt_path)
+
+        # running min of loss[epoch_lookback:epoch+1]
+        epoch_lookback = max(1, int(epoch - lookback))
+        util.training.update_window_min(window_min, epoch, loss[epoch], epoch_lookback)
 
         # end training if no improvement made in a while and more than half way done
-        epoch_lookback = np.maximum(1, int(epoch - .25*n_epochs)) # lookback is 25% of samples by default
-        if epoch_lookback > frac_start_save*n_epochs+1:
-            loss_best_lookback = torch.min(loss[epoch_lookback:epoch+1])
-            percent_improvement = (loss_best - loss_best_lookback)/torch.abs(loss_best) # positive is better
+        if epoch_lookback > start_save_epoch+1:
+            loss_best_lookback = window_min[0][1]
+            percent_improvement = (loss_best - loss_best_lookback)/abs(loss_best) # positive is better
             if percent_improvement < 0.0:
                 print('stopping early at epoch = %d' % epoch)
                 break
 
+    # wait for pending checkpoint writes (and raise any error from them)
+    io_exec.shutdown(wait=True)
+    if save_future is not None:
+        save_future.result()
+
     # reload best model if saving
     if saved_model:
-        checkpoint = torch.load(os.path.join(path_checkpoint, 'checkpoint.tar'))
+        checkpoint = torch.load(ckpt_path)
         model.load_state_dict(checkpoint['model_state_dict'])
         print('reloading best model from epoch = %d' % checkpoint['epoch'])
         model.eval()
 
 
-    return loss[:epoch]
+    return torch.from_numpy(loss[:epoch])
 
 
-def train_score(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n_rep_opt=10, print_freq=None, frac_start_save=1):
-    loss = torch.zeros(n_epochs)
-    loss_best = 1e9 # Need better way of initializing to make sure it's big enough
+def train_score(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n_rep_opt=10, print_freq=None, frac_start_save=1, path_checkpoint='./', use_compile=False):
+    '''
+    path_checkpoint: after frac_start_save*n_epochs (never with the default of 1) the lowest loss model so far is saved here.
+                     It isn't reloaded (the losses are single noisy estimates), so the model is left in its final state
+    use_compile: if True, wrap the fixed point updates in torch.compile
+    '''
+    loss = np.zeros(n_epochs, dtype=np.float32) # -elbo estimates from compute_loss_gradients, kept on cpu as in train
+    loss_best = float('inf')
     model.precompute(x, x_linear)
 
+    # fixed point updates run every epoch with the same shapes, so they only compile once
+    # (compute_loss_gradients stays eager: it calls backward and assigns .grad itself)
+    fixed_point_step = lambda: model.fixed_point_updates(x, y, x_linear=x_linear, temperature=1)
+    if use_compile:
+        fixed_point_step = torch.compile(fixed_point_step, dynamic=False)
+
+    params = [p for p in model.parameters() if p.requires_grad] # for gradient clipping
+
+    # checkpoints are written by a background thread
+    io_exec = ThreadPoolExecutor(max_workers=1)
+    save_future = None
+    staged = None # cpu snapshot of the model, reused between saves
+
     for epoch in range(n_epochs):
 
         # TEMPERATURE HARDECODED, NEED TO FIX
@@ -254,31 +364,28 @@ def train_score(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n
         #temperature_kl = epoch / (n_epochs/2) if epoch < n_epochs/2 else 1
         temperature_kl = 0. # SET TO ZERO TO IGNORE KL
 
+        # average the score function estimates over n_rep_opt samples, then take one step
+        optimizer.zero_grad(set_to_none=True)
+        loss_epoch = 0.
         for i in range(n_rep_opt):
+            l = model.compute_loss_gradients(x, y, x_linear=x_linear, temperature=temperature_kl, scale=1./n_rep_opt)
+            loss_epoch += l/n_rep_opt # same samples as the gradient estimate, so no extra forward pass
 
-            optimizer.zero_grad()
+        torch.nn.utils.clip_grad_norm_(params, 100, foreach=True)
+        optimizer.step()
 
-            model.compute_loss_gradients(x, y, x_linear=x_linear, temperature=temperature_kl)
+        loss[epoch] = loss_epoch.item() # one read back per epoch
 
-            # backward
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 100)
-            optimizer.step()
-
-        with torch.no_grad():
-            model.fixed_point_updates(x, y, x_linear=x_linear, temperature=1)
+        _end_epoch(fixed_point_step, model, x, y, epoch, n_epochs, print_freq)
 
         if epoch > frac_start_save*n_epochs and loss[epoch] < loss_best: 
             print('saving...')
             loss_best = loss[epoch]
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'loss': loss[epoch],
-            }, 'checkpoint.tar')
+            save_future, staged = util.training.checkpoint_async(io_exec, save_future, staged, model, optimizer, epoch, float(loss[epoch]), os.path.join(path_checkpoint, 'checkpoint.tar'))
 
-        if print_freq is not None:
-            if (epoch + 1) % print_freq == 0:
-                model.print_state(x, y, epoch+1, n_epochs)
+    # wait for pending checkpoint writes (and raise any error from them)
+    io_exec.shutdown(wait=True)
+    if save_future is not None:
+        save_future.result()
 
-    return loss
+    return torch.from_numpy(loss)
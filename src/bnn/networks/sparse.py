@@ -1,6 +1,7 @@
 # standard library imports
 import os
 import math
+import copy
 from math import sqrt, pi
 
 # package imports
@@ -19,15 +20,32 @@ tf.keras.backend.set_floatx('float32')
 # local imports
 import bnn.layers.sparse as layers
 import bnn.inference
+from bnn.inference.mcmc import train, train_score # the training loops live in mcmc, kept importable from here
 import bnn.util as util
 
+_LOG_2PI = math.log(2*math.pi)
+_SQRT_EPS = 1e-12 # keeps the gradient of sqrt finite at zero (otherwise NaNs in HMC)
+
+def get_penalty(penalty_type='l1'):
+    '''
+    Returns function applied to squared gradient norms: 'l1' for lasso penalty, 'l2' for ridge penalty
+    '''
+    if penalty_type == 'l1':
+        return lambda grad_f_sq: tf.math.sqrt(grad_f_sq + _SQRT_EPS)
+    elif penalty_type == 'l2':
+        return lambda grad_f_sq: grad_f_sq
+    else:
+        raise ValueError('penalty not recognized: %s' % penalty_type)
+
 class BayesLinearLasso(nn.Module):
     """
     Linear regression with double expential prior
     """
-    def __init__(self, dim_in, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None):
+    def __init__(self, dim_in, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, dtype=tf.float64):
         super(BayesLinearLasso, self).__init__()
 
+        self.dtype = dtype
+
         ### architecture
         self.dim_in = dim_in
         self.dim_out = dim_out
@@ -38,22 +56,30 @@ class BayesLinearLasso(nn.Module):
         self.scale_groups = scale_groups
 
         
-    def make_unnormalized_log_prob_tf(self, x, y):
-
-        # Convert to tensors
-        y_tf = tf.convert_to_tensor(y)
-        x_tf = tf.convert_to_tensor(x)
-        scale_global_tf = tf.dtypes.cast(tf.convert_to_tensor(self.scale_global), tf.float64)
+    def make_unnormalized_log_prob_tf(self, x_tf, y_tf):
+        '''
+        x_tf, y_tf: tf tensors of dtype self.dtype (converted once in train)
+        '''
+        scale_global_tf = tf.dtypes.cast(tf.convert_to_tensor(self.scale_global), self.dtype)
 
         if self.groups is not None:
-            groups_tf = [tf.convert_to_tensor(group) for group in self.groups]
+            # flatten groups into (index, group id) pairs so all group norms are one segment_sum
+            flat_idx_tf = tf.constant(np.concatenate(self.groups), dtype=tf.int32)
+            seg_id_tf = tf.constant(np.repeat(np.arange(len(self.groups)), [len(g) for g in self.groups]), dtype=tf.int32)
+            scale_groups_tf = tf.cast(tf.convert_to_tensor(self.scale_groups), self.dtype) # (G,)
 
-        @tf.function
+        # precompute sufficient statistics so each step is O(D^2) rather than O(N*D)
+        xx_tf = tf.matmul(x_tf, x_tf, transpose_a=True) # (D, D)
+        xy_tf = tf.matmul(x_tf, y_tf, transpose_a=True) # (D, 1)
+        yy_tf = tf.reduce_sum(y_tf*y_tf)
+
+        @tf.function(jit_compile=True, input_signature=[tf.TensorSpec((self.dim_in,1), self.dtype)])
         def unnormalized_log_prob(w):
-            resid = y_tf - x_tf@w
+            # (y - xw)^T(y - xw) = y^Ty - 2w^Tx^Ty + w^Tx^Txw
+            ssr = yy_tf - 2*tf.reduce_sum(w*xy_tf) + tf.reduce_sum(w*(xx_tf@w))
 
             # likelihood and L2 penalty
-            log_prob = -1/(2*self.noise_sig2)*tf.transpose(resid)@(resid)
+            log_prob = -1/(2*self.noise_sig2)*ssr
                        
             # L2 penalty?
             #log_prob += - 1/(2*prior_w2_sig2)*tf.transpose(w2)@w2
@@ -65,27 +91,32 @@ class BayesLinearLasso(nn.Module):
 
             # Group level
             if self.groups is not None:
-                for scale_groups, group in zip(self.scale_groups, groups_tf):
-                    log_prob -= scale_groups*tf.norm(tf.gather(w, group)) # L1 penalty
-                    #log_prob -= scale_groups*tf.norm(tf.gather(w, group)**2) # L2 penalty
+                w_sel = tf.gather(w[:,0], flat_idx_tf)
+                group_sqsum = tf.math.segment_sum(w_sel*w_sel, seg_id_tf) # (G,)
+                log_prob -= tf.reduce_sum(scale_groups_tf*tf.math.sqrt(group_sqsum + _SQRT_EPS)) # L1 penalty
+                #log_prob -= tf.reduce_sum(scale_groups_tf*group_sqsum) # L2 penalty
 
-            return log_prob[0,0]
+            return log_prob
 
         return unnormalized_log_prob
 
-    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3)):
+    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3), sampler='hmc'):
         '''
         Train with HMC
         '''
-        unnormalized_log_prob_tf = self.make_unnormalized_log_prob_tf(x, y)
-        init_values = .1*np.random.randn(self.dim_in,1)
+        x_tf = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y_tf = tf.cast(tf.convert_to_tensor(y), self.dtype)
+
+        unnormalized_log_prob_tf = self.make_unnormalized_log_prob_tf(x_tf, y_tf)
+        init_values = tf.cast(.1*np.random.randn(self.dim_in,1), self.dtype)
 
         samples, accept = bnn.inference.mcmc.hmc_tf(unnormalized_log_prob_tf, 
             init_values, 
             num_results, 
             num_burnin_steps, 
             num_leapfrog_steps=3, 
-            step_size=1.)
+            step_size=1.,
+            sampler=sampler)
 
         return samples, accept
 
@@ -95,9 +126,11 @@ class RffGradPen(nn.Module):
 
     Variance of output layer scaled by width (see RFF activation function)
     """
-    def __init__(self, dim_in, dim_hidden, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1'):
+    def __init__(self, dim_in, dim_hidden, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', dtype=tf.float64):
         super(RffGradPen, self).__init__()
 
+        self.dtype = dtype # for HMC
+
         ### architecture
         self.dim_in = dim_in
         self.dim_hidden = dim_hidden
@@ -110,12 +143,18 @@ class RffGradPen(nn.Module):
         self.lengthscale = lengthscale
         self.penalty_type = penalty_type
 
+        # flattened group membership: input member_ids[j] belongs to group group_ids[j]
+        if groups is not None:
+            self.register_buffer('group_ids', torch.cat([torch.full((len(group),), i, dtype=torch.long) for i, group in enumerate(groups)]), persistent=False)
+            self.register_buffer('member_ids', torch.cat([torch.as_tensor(group, dtype=torch.long) for group in groups]), persistent=False)
+
         self.register_buffer('w', torch.empty(dim_hidden, dim_in))
         self.register_buffer('b', torch.empty(dim_hidden))
 
         self.sample_features()
 
-        self.act = lambda z: sqrt(2/self.dim_hidden)*torch.cos(z)
+        self.register_buffer('_rff_scale', torch.tensor(sqrt(2/dim_hidden)), persistent=False) # RFF output scaling
+        self.act = lambda z: self._rff_scale*torch.cos(z)
 
     def sample_features(self):
         # sample random weights for RFF features
@@ -126,103 +165,145 @@ class RffGradPen(nn.Module):
         #return self.act(x@self.w.T + self.b.reshape(1,-1)) # (n, dim_hidden)
         return self.act(F.linear(x, self.w, self.b)) # (n, dim_hidden)
 
-    def compute_jacobian(self, x):
+    def jacobian_hidden_features(self, x):
         '''
-        Compute jacobian of hidden units with respect to inputs. 
-        Assumes inputs do not impact each other (i.e. input observation n only impacts hidden for observation n)
+        Analytical jacobian of hidden units with respect to inputs.
+        Input observation n only impacts hidden units for observation n.
 
         Inputs:
             x: (n_obs, dim_in) tensor
 
         Outputs:
-            jac: (n_obs, dim_out, dim_in) tensor of derivatives
+            jac: (n_obs, dim_hidden, dim_in) tensor of derivatives
         '''
-        jac = []
-        for n in range(x.shape[0]):
-            jac_n = torch.autograd.functional.jacobian(self.hidden_features, x[n,:].reshape(1,-1)).squeeze() # dim_hidden x dim_in
-            jac.append(jac_n)
-        return torch.stack(jac) # n_obs x dim_out x dim_in
+        return -self._rff_scale * self.w.unsqueeze(0) * torch.sin(F.linear(x, self.w, self.b)).unsqueeze(-1) # analytical jacobian
 
+    def compute_jacobian(self, x):
+        '''
+        Jacobian of hidden units with respect to inputs by automatic differentiation.
+        Same output as jacobian_hidden_features, but doesn't rely on the closed form (e.g. if the activation is changed)
+
+        Inputs:
+            x: (n_obs, dim_in) tensor
 
-    def compute_Ax(self, x):
+        Outputs:
+            jac: (n_obs, dim_hidden, dim_in) tensor of derivatives
+        '''
+        # one batched vjp pass over observations rather than a loop of per-observation jacobians
+        hidden_features_single = lambda x_n: self.hidden_features(x_n.unsqueeze(0)).squeeze(0) # (dim_in,) -> (dim_hidden,)
+        return torch.func.vmap(torch.func.jacrev(hidden_features_single))(x) # n_obs x dim_hidden x dim_in
+
+    def compute_Ax(self, x, analytical_jacobian=True, pre=None):
         '''
         Computes A matrix
+
+        pre: optional precomputed preactivations xw+b (N x K), shared with hidden_features
         '''
         n = x.shape[0]
-        J = self.compute_jacobian(x) # N x K x D
-
-        #Ja = -sqrt(2/self.dim_hidden) * self.w.unsqueeze(0) * torch.sin(F.linear(x, self.w, self.b)).unsqueeze(-1) #analytical jacobian
-
-        # all inputs
-        A_d = [1/n*J[:,:,d].T@J[:,:,d] for d in range(self.dim_in)]
+        if analytical_jacobian:
+            # J[n,k,d] = -c * sin(xw+b)[n,k] * w[k,d], so A_d = c^2/n * (S^T S) * (w_d w_d^T) elementwise
+            # and the N x K x D jacobian never needs to be formed
+            if pre is None:
+                pre = F.linear(x, self.w, self.b)
+            S = torch.sin(pre) # N x K
+            A_d = self._rff_scale**2 / n * (S.T @ S).unsqueeze(0) * torch.einsum('kd,md->dkm', self.w, self.w) # D x K x K
+        else:
+            J = self.compute_jacobian(x) # N x K x D
+            A_d = torch.einsum('nkd,nmd->dkm', J, J) / n # D x K x K
 
         # groups of inputs
         if self.groups is not None:
-            A_groups = [torch.sum(torch.stack([A_d[i] for i in group]),0) for group in self.groups]
+            A_groups = A_d.new_zeros(len(self.groups), self.dim_hidden, self.dim_hidden).index_add_(0, self.group_ids, A_d[self.member_ids]) # G x K x K
         else:
             A_groups = None
 
         return A_d, A_groups
 
-    def make_unnormalized_log_prob_tf(self, x, y):
+    def make_unnormalized_log_prob_tf(self, x, y_tf, h_tf=None, pre=None):
+        '''
+        x: torch tensor (used for the gradient penalty)
+        y_tf: tf tensor of dtype self.dtype
+        h_tf: optional precomputed hidden features as a tf tensor
+        pre: optional precomputed preactivations xw+b, so cos (features) and sin (jacobian) share one pass over x
+        '''
+        if pre is None:
+            pre = F.linear(x, self.w, self.b) # N x K
 
         # Set prior (since based on data)
-        Ax_d, Ax_groups = self.compute_Ax(x)
+        Ax_d, Ax_groups = self.compute_Ax(x, pre=pre)
 
         # Convert to tensors
-        y_tf = tf.convert_to_tensor(y)
-        h_tf = tf.convert_to_tensor(self.hidden_features(x))
-        Ax_d_tf = [tf.convert_to_tensor(A) for A in Ax_d]
+        if h_tf is None:
+            h_tf = tf.cast(tf.convert_to_tensor(self.act(pre).detach().cpu().numpy()), self.dtype)
+        Ax_d_tf = tf.cast(tf.convert_to_tensor(Ax_d.detach().cpu().numpy()), self.dtype) # D x K x K
+        scale_global_tf = tf.convert_to_tensor(np.asarray(self.scale_global, dtype=self.dtype.as_numpy_dtype)) # (D,)
+        penalty = get_penalty(self.penalty_type) # resolved outside of traced function
         
         if Ax_groups is not None:
-            Ax_groups_tf = [tf.convert_to_tensor(A) for A in Ax_groups]
+            Ax_groups_tf = tf.cast(tf.convert_to_tensor(Ax_groups.detach().cpu().numpy()), self.dtype) # G x K x K
+            scale_groups_tf = tf.convert_to_tensor(np.asarray(self.scale_groups, dtype=self.dtype.as_numpy_dtype)) # (G,)
 
-        @tf.function
+        # precompute sufficient statistics so each step is O(K^2) rather than O(N*K)
+        hh_tf = tf.matmul(h_tf, h_tf, transpose_a=True) # (K, K)
+        hy_tf = tf.matmul(h_tf, y_tf, transpose_a=True) # (K, 1)
+        yy_tf = tf.reduce_sum(y_tf*y_tf)
+
+        @tf.function(jit_compile=True, input_signature=[tf.TensorSpec((self.dim_hidden,1), self.dtype)])
         def unnormalized_log_prob(w):
-            resid = y_tf - h_tf@w
+            # (y - hw)^T(y - hw) = y^Ty - 2w^Th^Ty + w^Th^Thw
+            ssr = yy_tf - 2*tf.reduce_sum(w*hy_tf) + tf.reduce_sum(w*(hh_tf@w))
 
             # likelihood
-            log_prob = -1/(2*self.noise_sig2)*tf.transpose(resid)@(resid)
+            log_prob = -1/(2*self.noise_sig2)*ssr
 
             # L2 penalty
-            log_prob += - 1/(2*self.prior_w2_sig2)*tf.transpose(w)@w 
-
-            ## likelihood and L2 penalty
-            #log_prob = -1/self.noise_sig2*tf.transpose(resid)@(resid) \
-            #           - tf.transpose(w)@(1/self.prior_w2_sig2*tf.eye(self.dim_hidden, dtype=tf.float64))@w 
+            log_prob += - 1/(2*self.prior_w2_sig2)*tf.reduce_sum(w*w)
 
             # Within group gradient penalty
-            for scale_global, A in zip(self.scale_global, Ax_d_tf):
-                grad_f_sq = tf.transpose(w)@(A)@w
-                if self.penalty_type == 'l1':
-                    log_prob += - scale_global*tf.math.sqrt(grad_f_sq)
-                elif self.penalty_type == 'l2':
-                    log_prob += - scale_global*grad_f_sq
+            grad_f_sq = tf.einsum('ki,dkm,mi->d', w, Ax_d_tf, w) # (D,)
+            log_prob += - tf.reduce_sum(scale_global_tf*penalty(grad_f_sq))
 
             # Group level gradient penalty
             if Ax_groups is not None:
-                for scale_groups, A in zip(self.scale_groups, Ax_groups_tf):
-                    log_prob -= scale_groups*tf.math.sqrt(tf.transpose(w)@(A)@w)
+                grad_f_sq_groups = tf.einsum('ki,gkm,mi->g', w, Ax_groups_tf, w) # (G,)
+                log_prob -= tf.reduce_sum(scale_groups_tf*tf.math.sqrt(grad_f_sq_groups + _SQRT_EPS))
 
-            return log_prob[0,0]
+            return log_prob
 
         return unnormalized_log_prob
 
 
-    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3)):
+    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3), precondition=False, sampler='hmc'):
         '''
         Train with HMC
+
+        precondition: use the Gaussian part of the posterior precision (h^Th/noise_sig2 + I/prior_w2_sig2) as the mass matrix
+        sampler: 'hmc' or 'nuts' (see bnn.inference.mcmc.hmc_tf)
         '''
-        unnormalized_log_prob_tf = self.make_unnormalized_log_prob_tf(x, y)
+        # convert once: torch for the features, tf for the sampler
+        x = torch.as_tensor(x)
+        y_tf = tf.cast(tf.convert_to_tensor(y), self.dtype)
+        pre = F.linear(x, self.w, self.b) # N x K, shared by the features and the gradient penalty
+        h_tf = tf.cast(tf.convert_to_tensor(self.act(pre).detach().cpu().numpy()), self.dtype)
 
-        init_values = .1*np.random.randn(self.dim_hidden,1) #tf.constant(.01, shape=(self.dim_hidden,1), dtype=tf.float64) 
+        unnormalized_log_prob_tf = self.make_unnormalized_log_prob_tf(x, y_tf, h_tf, pre)
+
+        init_values = tf.cast(.1*np.random.randn(self.dim_hidden,1), self.dtype) #tf.constant(.01, shape=(self.dim_hidden,1), dtype=self.dtype) 
+
+        momentum_distribution = None
+        if precondition:
+            HtH = tf.matmul(h_tf, h_tf, transpose_a=True)
+            precision = HtH/self.noise_sig2 + tf.eye(self.dim_hidden, dtype=self.dtype)/self.prior_w2_sig2
+            momentum_distribution = bnn.inference.mcmc.momentum_from_precision(precision)
 
         samples, accept = bnn.inference.mcmc.hmc_tf(unnormalized_log_prob_tf, 
             init_values, 
             num_results, 
             num_burnin_steps, 
             num_leapfrog_steps=3, 
-            step_size=1.)
+            step_size=1.,
+            momentum_distribution=momentum_distribution,
+            sampler=sampler)
 
         return samples, accept
 
@@ -245,10 +326,13 @@ class RffGradPenHyper(nn.Module):
     -   scale_groups: NOT IMPLEMENTED
     -   lengthscale: Corresponds to lengthscale of RBF kernel. (scalar)
     -   penalty_type: select 'l1' for lasso penalty, 'l2' for ridge penalty (str)
+    -   dtype: tensorflow dtype used for features and HMC state (tf.float32 or tf.float64)
     """
-    def __init__(self, dim_in, dim_hidden, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1'):
+    def __init__(self, dim_in, dim_hidden, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', dtype=tf.float64):
         super(RffGradPenHyper, self).__init__()
 
+        self.dtype = dtype
+
         ### architecture
         self.dim_in = dim_in
         self.dim_hidden = dim_hidden
@@ -266,16 +350,18 @@ class RffGradPenHyper(nn.Module):
 
         self.sample_features()
 
-        self.act = lambda z: sqrt(2/self.dim_hidden)*torch.cos(z)
-        self.act_tf = lambda z: sqrt(2/self.dim_hidden)*tf.math.cos(z)
+        self.register_buffer('_rff_scale', torch.tensor(sqrt(2/dim_hidden)), persistent=False) # RFF output scaling
+        self._rff_scale_tf = tf.constant(sqrt(2/dim_hidden), dtype=self.dtype)
+        self.act = lambda z: self._rff_scale*torch.cos(z)
+        self.act_tf = lambda z: self._rff_scale_tf*tf.math.cos(z)
 
     def sample_features(self):
         # sample random weights for RFF features
         self.w.normal_(0, 1)
         self.b.uniform_(0, 2*pi)
 
-        self.w_tf = tf.convert_to_tensor(self.w)
-        self.b_tf = tf.convert_to_tensor(self.b)
+        self.w_tf = tf.cast(tf.convert_to_tensor(self.w), self.dtype)
+        self.b_tf = tf.cast(tf.convert_to_tensor(self.b), self.dtype)
         
     def hidden_features(self, x, lengthscale=1.0):
         #return self.act(x@self.w.T + self.b.reshape(1,-1)) # (n, dim_hidden)
@@ -288,90 +374,90 @@ class RffGradPenHyper(nn.Module):
     def hidden_features_tf_precompute(self, x_w_tf, lengthscale=1.0):
         return self.act_tf(x_w_tf / lengthscale + tf.reshape(self.b_tf, (1,-1))) # (n, dim_hidden)
 
-    def make_unnormalized_log_prob_tf(self, x, y):
-
-        # Convert to tensors
-        x_tf = tf.convert_to_tensor(x)
-        y_tf = tf.convert_to_tensor(y)
-        n = x.shape[0]
+    def make_unnormalized_log_prob_tf(self, x_tf, y_tf):
+        '''
+        x_tf, y_tf: tf tensors of dtype self.dtype (converted once in train)
+        '''
+        n = x_tf.shape[0]
 
-        # for lengthscale prior and prior_w2_sig2 hyperprior
-        l_alpha = tf.convert_to_tensor(1.0, dtype=tf.float64)
-        l_beta = tf.convert_to_tensor(1.0, dtype=tf.float64)
+        # for lengthscale prior and prior_w2_sig2 hyperprior (python floats, so they are folded into the compiled graph)
+        l_alpha, l_beta = 1.0, 1.0
+        prior_w2_sig2_alpha, prior_w2_sig2_beta = 1.0, 1.0
 
-        prior_w2_sig2_alpha = tf.convert_to_tensor(1.0, dtype=tf.float64)
-        prior_w2_sig2_beta = tf.convert_to_tensor(1.0, dtype=tf.float64)
-
-        def log_prob_invgamma(x, alpha, beta):
-            unnormalized_prob = -(1. + alpha) * tf.math.log(x) - beta / x
-            normalization = (
-            tf.math.lgamma(alpha) - alpha * tf.math.log(beta))
-            return unnormalized_prob - normalization
+        # inverse gamma normalizing constants, lgamma(alpha) - alpha*log(beta)
+        l_norm = math.lgamma(l_alpha) - l_alpha*math.log(l_beta)
+        prior_w2_sig2_norm = math.lgamma(prior_w2_sig2_alpha) - prior_w2_sig2_alpha*math.log(prior_w2_sig2_beta)
 
         # precompute
-        x_w_tf = x @ tf.transpose(self.w_tf)
+        x_w_tf = x_tf @ tf.transpose(self.w_tf)
+        b_row_tf = tf.reshape(self.b_tf, (1,-1))
+        scale_global_tf = tf.convert_to_tensor(np.asarray(self.scale_global, dtype=self.dtype.as_numpy_dtype)) # (D,)
+        penalty = get_penalty(self.penalty_type) # resolved outside of traced function
 
-        @tf.function
+        @tf.function(jit_compile=True, input_signature=[tf.TensorSpec((self.dim_hidden,1), self.dtype), tf.TensorSpec((), self.dtype), tf.TensorSpec((), self.dtype)])
         def unnormalized_log_prob(w, l, prior_w2_sig2):
             '''
             w: output layer weights
             l: lengthscale
             '''
 
-            h_tf = self.hidden_features_tf_precompute(x_w_tf, l)
+            # shared by hidden features and their jacobian
+            phase = x_w_tf / l + b_row_tf # (N, K)
+
+            h_tf = self.act_tf(phase)
             resid = y_tf - h_tf@w
 
-            # Jacobian of hidden layer (N x K x D)
-            J = -sqrt(2/self.dim_hidden) * tf.expand_dims(self.w_tf,0) / l * tf.expand_dims(tf.math.sin(x_w_tf / l + tf.reshape(self.b_tf, (1,-1))), -1) # analytical jacobian
-            
-            # gradient penalties for each input dimension
-            Ax_d_tf = [1/n*tf.transpose(J[:,:,d])@J[:,:,d] for d in range(self.dim_in)]
+            # gradient penalties for each input dimension, factored so the (N, K, D) jacobian is never formed:
+            # J[n,k,d] = -c/l * sin(phase)[n,k] * w_tf[k,d], so A_d = c^2/(l^2 n) * (S^T S) * (w_d w_d^T) elementwise
+            S = tf.math.sin(phase) # (N, K)
+            G = tf.matmul(S, S, transpose_a=True) # (K, K), shared across input dimensions
 
             # likelihood
-            log_prob = -1/(2*self.noise_sig2)*tf.transpose(resid)@(resid)
+            log_prob = -1/(2*self.noise_sig2)*tf.reduce_sum(resid*resid)
 
             # L2 penalty
-            log_prob += - 1/(2*prior_w2_sig2)*tf.transpose(w)@w 
+            log_prob += - 1/(2*prior_w2_sig2)*tf.reduce_sum(w*w)
 
-            # prior_w2_sig2 hyperprior
-            log_prob += log_prob_invgamma(prior_w2_sig2, prior_w2_sig2_alpha, prior_w2_sig2_beta)
+            # prior_w2_sig2 hyperprior (inverse gamma)
+            log_prob += -(1. + prior_w2_sig2_alpha)*tf.math.log(prior_w2_sig2) - prior_w2_sig2_beta/prior_w2_sig2 - prior_w2_sig2_norm
 
-            # lengthscale prior
-            log_prob += log_prob_invgamma(l, l_alpha, l_beta)
+            # lengthscale prior (inverse gamma)
+            log_prob += -(1. + l_alpha)*tf.math.log(l) - l_beta/l - l_norm
             
             # Within group gradient penalty
-            for scale_global, A in zip(self.scale_global, Ax_d_tf):
-                grad_f_sq = tf.transpose(w)@(A)@w
-                if self.penalty_type == 'l1':
-                    log_prob += - scale_global*tf.math.sqrt(grad_f_sq)
-                elif self.penalty_type == 'l2':
-                    log_prob += - scale_global*grad_f_sq
+            V = w * self.w_tf # (K, D), w_k * w_tf[k,d]
+            grad_f_sq = self._rff_scale_tf**2 / (l**2 * n) * tf.einsum('kd,km,md->d', V, G, V) # (D,)
+            log_prob += - tf.reduce_sum(scale_global_tf*penalty(grad_f_sq))
 
             '''
             # Group level gradient penalty
             if Ax_groups is not None:
                 for scale_groups, A in zip(self.scale_groups, Ax_groups_tf):
-                    log_prob -= scale_groups*tf.math.sqrt(tf.transpose(w)@(A)@w)
+                    log_prob -= scale_groups*tf.math.sqrt(tf.reduce_sum(w*(A@w)))
             '''
 
-            return log_prob[0,0]
+            return log_prob
 
         return unnormalized_log_prob
 
 
-    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3)):
+    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3), sampler='hmc'):
         '''
         Train with HMC
         '''
-        unnormalized_log_prob_tf = self.make_unnormalized_log_prob_tf(x, y)
-        init_values = [.1*np.random.randn(self.dim_hidden,1), tf.constant(1.0, dtype=tf.float64), tf.constant(1.0, dtype=tf.float64)]
+        x_tf = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y_tf = tf.cast(tf.convert_to_tensor(y), self.dtype)
+
+        unnormalized_log_prob_tf = self.make_unnormalized_log_prob_tf(x_tf, y_tf)
+        init_values = [tf.cast(.1*np.random.randn(self.dim_hidden,1), self.dtype), tf.constant(1.0, dtype=self.dtype), tf.constant(1.0, dtype=self.dtype)]
 
         samples, accept = bnn.inference.mcmc.hmc_tf(unnormalized_log_prob_tf, 
             init_values, 
             num_results, 
             num_burnin_steps, 
             num_leapfrog_steps=3, 
-            step_size=1.)
+            step_size=1.,
+            sampler=sampler)
 
         return samples, accept
 
@@ -394,10 +480,13 @@ class RffGradPenHyper_v2(object):
     -   scale_groups: NOT IMPLEMENTED
     -   lengthscale: Corresponds to lengthscale of RBF kernel. (scalar)
     -   penalty_type: select 'l1' for lasso penalty, 'l2' for ridge penalty (str)
+    -   dtype: tensorflow dtype used for features and HMC state (tf.float32 or tf.float64)
     """
-    def __init__(self, dim_in, dim_hidden, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', family='gaussian'):
+    def __init__(self, dim_in, dim_hidden, dim_out, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', family='gaussian', dtype=tf.float32):
         super(RffGradPenHyper_v2, self).__init__()
 
+        self.dtype = dtype
+
         ### architecture
         self.dim_in = dim_in
         self.dim_hidden = dim_hidden
@@ -412,17 +501,23 @@ class RffGradPenHyper_v2(object):
         self.family = family
 
         self.sample_features()
-        self.act = lambda z: sqrt(2/self.dim_hidden)*tf.math.cos(z)
+        self._rff_scale = tf.constant(sqrt(2/self.dim_hidden), dtype=self.dtype) # RFF output scaling
+        self.act = lambda z: self._rff_scale*tf.math.cos(z)
 
     def sample_features(self):
         # sample random weights for RFF features
-        self.w1 = tf.cast(tf.convert_to_tensor(np.random.normal(0,1,(self.dim_hidden, self.dim_in))), dtype=tf.float32)
-        self.b1 = tf.cast(tf.convert_to_tensor(np.random.uniform(0,2*pi,(self.dim_hidden,))), dtype=tf.float32)
+        # stored as (dim_in, dim_hidden) so x @ w1 needs no transpose
+        self.w1 = tf.cast(tf.convert_to_tensor(np.random.normal(0,1,(self.dim_in, self.dim_hidden))), dtype=self.dtype)
+        self.b1 = tf.cast(tf.convert_to_tensor(np.random.uniform(0,2*pi,(self.dim_hidden,))), dtype=self.dtype)
+
+        # cached so they aren't rebuilt on every call / trace
+        self.w1T = tf.transpose(self.w1) # (dim_hidden, dim_in), for the jacobian
+        self.b1_row = tf.reshape(self.b1, (1,-1)) # (1, dim_hidden)
 
     def compute_xw1(self, x):
         if not tf.is_tensor(x):
-            x = tf.convert_to_tensor(x, dtype=tf.float32)
-        return x @ tf.transpose(self.w1)
+            x = tf.convert_to_tensor(x, dtype=self.dtype)
+        return x @ self.w1
 
     def hidden_features(self, x=None, xw1=None, lengthscale=None):
         if xw1 is None:
@@ -430,7 +525,7 @@ class RffGradPenHyper_v2(object):
         if lengthscale is None:
             lengthscale = self.lengthscale
 
-        return self.act(xw1 / lengthscale + tf.reshape(self.b1, (1,-1))) # (n, dim_hidden)
+        return self.act(xw1 / lengthscale + self.b1_row) # (n, dim_hidden)
 
     def forward(self, w2, x=None, xw1=None, lengthscale=None, h=None):
         if h is None:
@@ -447,12 +542,12 @@ class RffGradPenHyper_v2(object):
             xw1 = self.compute_xw1(x)
         if lengthscale is None:
             lengthscale = self.lengthscale
-        return -sqrt(2/self.dim_hidden) * tf.expand_dims(self.w1,0) / lengthscale * tf.expand_dims(tf.math.sin(xw1 / lengthscale + tf.reshape(self.b1, (1,-1))), -1) # analytical jacobian
+        return -self._rff_scale * tf.expand_dims(self.w1T,0) / lengthscale * tf.expand_dims(tf.math.sin(xw1 / lengthscale + self.b1_row), -1) # analytical jacobian
 
     def grad_norm(self, x=None, xw1=None, lengthscale=None):
         J = self.jacobian_hidden_features(x=x, xw1=xw1, lengthscale=lengthscale)
-        Ax_d = [1/J.shape[0]*tf.transpose(J[:,:,d])@J[:,:,d] for d in range(self.dim_in)]
-        return Ax_d
+        Ax_d = tf.einsum('nkd,nmd->dkm', J, J) / J.shape[0]
+        return Ax_d # D x K x K
 
     def log_marginal_likelihood(self, x, y):
 
@@ -470,13 +565,13 @@ class RffGradPenHyper_v2(object):
 
         ## regular log marginal likelihood
         n = x.shape[0]
-        x = tf.cast(tf.convert_to_tensor(x), tf.float32)
-        y = tf.cast(tf.convert_to_tensor(y), tf.float32)
+        x = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y = tf.cast(tf.convert_to_tensor(y), self.dtype)
 
         h = self.hidden_features(x)
         K = h @ tf.transpose(h) * self.prior_w2_sig2
 
-        A = K + self.noise_sig2*tf.eye(n)
+        A = K + self.noise_sig2*tf.eye(n, dtype=self.dtype)
 
         log_prob = -0.5*n*np.log(2*np.pi) - 0.5*tf.linalg.logdet(A) - 0.5*tf.transpose(y) @ tf.linalg.inv(A) @ y
 
@@ -486,7 +581,7 @@ class RffGradPenHyper_v2(object):
         phi = h * np.sqrt(self.dim_hidden/2)
 
 
-        A = tf.transpose(phi)@phi + m*self.noise_sig2/self.prior_w2_sig2*tf.eye(2*m)
+        A = tf.transpose(phi)@phi + m*self.noise_sig2/self.prior_w2_sig2*tf.eye(2*m, dtype=self.dtype)
 
         R = tf.linalg.cholesky(A)
         alpha1 = tf.linalg.solve(R, tf.transpose(phi)@y)
@@ -506,7 +601,7 @@ class RffGradPenHyper_v2(object):
             h = self.hidden_features(x=None, xw1=xw1, lengthscale=lengthscale)
             m = int(self.dim_hidden / 2)
             phi = h * np.sqrt(self.dim_hidden/2)
-            A = tf.transpose(phi)@phi + m*self.noise_sig2/self.prior_w2_sig2*tf.eye(2*m)
+            A = tf.transpose(phi)@phi + m*self.noise_sig2/self.prior_w2_sig2*tf.eye(2*m, dtype=self.dtype)
             R = tf.linalg.cholesky(A)
             alpha1 = tf.linalg.solve(R, tf.transpose(phi)@y)
             log_prob = -1/(2*self.noise_sig2)*(tf.norm(y)**2 - tf.norm(alpha1)**2) - 0.5*tf.reduce_sum(tf.math.log(tf.linalg.diag_part(R)**2)) + m*tf.math.log(m*self.noise_sig2/self.prior_w2_sig2) - n/2*np.log(2*np.pi*self.noise_sig2)
@@ -519,20 +614,20 @@ class RffGradPenHyper_v2(object):
 
     def train_log_marginal_likelihood(self, x, y, n_epochs, learning_rate=0.001, early_stopping=False, tol=1e-4, patience=3, clipvalue=100, batch_size=None):
         
-        x = tf.cast(tf.convert_to_tensor(x), tf.float32)
-        y = tf.cast(tf.convert_to_tensor(y), tf.float32)
+        x = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y = tf.cast(tf.convert_to_tensor(y), self.dtype)
 
         hyperparam_hist = {}
         
 
-        lengthscale_map = tfp.math.softplus_inverse(tf.constant(self.lengthscale, dtype=tf.float32)) # note: _map is untransformed by softplus
+        lengthscale_map = tfp.math.softplus_inverse(tf.constant(self.lengthscale, dtype=self.dtype)) # note: _map is untransformed by softplus
         
-        lengthscale_map = tf.Variable(lengthscale_map, dtype=np.float32)
+        lengthscale_map = tf.Variable(lengthscale_map, dtype=self.dtype)
         hyperparam_hist['lengthscale'] = [tf.math.softplus(lengthscale_map).numpy()]
         print('lengthscale init: ', hyperparam_hist['lengthscale'][0])
 
-        #prior_w2_sig2_map = tfp.math.softplus_inverse(tf.constant(self.prior_w2_sig2, dtype=tf.float32)) # note: _map is untransformed by softplus
-        #prior_w2_sig2_map = tf.Variable(prior_w2_sig2_map, dtype=np.float32)
+        #prior_w2_sig2_map = tfp.math.softplus_inverse(tf.constant(self.prior_w2_sig2, dtype=self.dtype)) # note: _map is untransformed by softplus
+        #prior_w2_sig2_map = tf.Variable(prior_w2_sig2_map, dtype=self.dtype)
         #hyperparam_hist['prior_w2_sig2'] = [tf.math.softplus(prior_w2_sig2_map).numpy()]
         #print('prior_w2_sig2 init: ', hyperparam_hist['prior_w2_sig2'][0])
 
@@ -604,11 +699,11 @@ class RffGradPenHyper_v2(object):
     def make_unnormalized_log_prob(self, x, y, infer_lengthscale=False):
 
         # for lengthscale prior and prior_w2_sig2 hyperprior (should move this to init...)
-        lengthscale_alpha = tf.convert_to_tensor(1.0, dtype=tf.float32)
-        lengthscale_beta = tf.convert_to_tensor(1.0, dtype=tf.float32)
+        lengthscale_alpha = tf.convert_to_tensor(1.0, dtype=self.dtype)
+        lengthscale_beta = tf.convert_to_tensor(1.0, dtype=self.dtype)
 
-        prior_w2_sig2_alpha = tf.convert_to_tensor(1.0, dtype=tf.float32)
-        prior_w2_sig2_beta = tf.convert_to_tensor(1.0, dtype=tf.float32)
+        prior_w2_sig2_alpha = tf.convert_to_tensor(1.0, dtype=self.dtype)
+        prior_w2_sig2_beta = tf.convert_to_tensor(1.0, dtype=self.dtype)
 
         def log_prob_invgamma(x, alpha, beta):
             unnormalized_prob = -(1. + alpha) * tf.math.log(x) - beta / x
@@ -619,8 +714,17 @@ class RffGradPenHyper_v2(object):
         xw1 = self.compute_xw1(x)
         h = self.hidden_features(x=None, xw1=xw1, lengthscale=self.lengthscale)
         Ax_d = self.grad_norm(x=None, xw1=xw1, lengthscale=self.lengthscale)
+        scale_global_tf = tf.convert_to_tensor(np.asarray(self.scale_global, dtype=self.dtype.as_numpy_dtype)) # (D,)
+        penalty = get_penalty(self.penalty_type) # resolved outside of traced function
 
-        @tf.function
+        # with a fixed lengthscale h is constant, so the gaussian likelihood only needs sufficient statistics
+        use_suff_stats = (not infer_lengthscale) and self.family == 'gaussian'
+        if use_suff_stats:
+            HtH = tf.einsum('nk,nm->km', h, h) # (K, K)
+            Hty = tf.matmul(h, y, transpose_a=True) # (K, 1)
+            yty = tf.reduce_sum(y*y)
+
+        @tf.function(jit_compile=True, reduce_retracing=True)
         def unnormalized_log_prob(w2, lengthscale, prior_w2_sig2, infer_lengthscale=infer_lengthscale, xw1=xw1, h=h, Ax_d=Ax_d, family=self.family):
             '''
             w2: output layer weights
@@ -635,12 +739,17 @@ class RffGradPenHyper_v2(object):
                 h = self.hidden_features(x=None, xw1=xw1, lengthscale=lengthscale)
                 Ax_d = self.grad_norm(x=None, xw1=xw1, lengthscale=lengthscale)
 
-            f_pred = self.forward(w2, h=h)
-            resid = y - f_pred
+            if not use_suff_stats:
+                f_pred = self.forward(w2, h=h)
+                resid = y - f_pred
 
             # likelihood
-            if family == 'gaussian':
-                log_prob = -1/(2*self.noise_sig2)*tf.transpose(resid)@(resid)
+            if use_suff_stats:
+                # (y - hw)^T(y - hw) = y^Ty - 2w^Th^Ty + w^Th^Thw, no N x K work per step
+                ssr = yty - 2*tf.reduce_sum(w2*Hty) + tf.reduce_sum(w2*(HtH@w2))
+                log_prob = -1/(2*self.noise_sig2)*ssr
+            elif family == 'gaussian':
+                log_prob = -1/(2*self.noise_sig2)*tf.reduce_sum(resid*resid)
             elif family == 'poisson':
                 log_prob = tf.reduce_sum(y * f_pred - tf.math.exp(f_pred))
             elif family == 'binomial':
@@ -649,7 +758,7 @@ class RffGradPenHyper_v2(object):
                 log_prob = tf.reduce_sum(y*f_pred - tf.math.log(1+tf.math.exp(f_pred)))
 
             # L2 penalty
-            log_prob += - 1/(2*prior_w2_sig2)*tf.transpose(w2)@w2
+            log_prob += - 1/(2*prior_w2_sig2)*tf.reduce_sum(w2*w2)
             
             # prior_w2_sig2 hyperprior
             log_prob += log_prob_invgamma(prior_w2_sig2, prior_w2_sig2_alpha, prior_w2_sig2_beta) 
@@ -658,21 +767,17 @@ class RffGradPenHyper_v2(object):
             log_prob += log_prob_invgamma(lengthscale**2, lengthscale_alpha, lengthscale_beta) 
             
             # Within group gradient penalty
-            for scale_global, A in zip(self.scale_global, Ax_d):
-                grad_f_sq = tf.transpose(w2)@(A)@w2
-                if self.penalty_type == 'l1':
-                    log_prob += - scale_global*tf.math.sqrt(grad_f_sq)
-                elif self.penalty_type == 'l2':
-                    log_prob += - scale_global*grad_f_sq
+            grad_f_sq = tf.einsum('ki,dkm,mi->d', w2, Ax_d, w2) # (D,)
+            log_prob += - tf.reduce_sum(scale_global_tf*penalty(grad_f_sq))
 
             '''
             # Group level gradient penalty
             if Ax_groups is not None:
                 for scale_groups, A in zip(self.scale_groups, Ax_groups_tf):
-                    log_prob -= scale_groups*tf.math.sqrt(tf.transpose(w)@(A)@w)
+                    log_prob -= scale_groups*tf.math.sqrt(tf.reduce_sum(w*(A@w)))
             '''
 
-            return log_prob[0,0]
+            return log_prob
 
         #@tf.function
         def unnormalized_log_prob_vec(params):
@@ -684,24 +789,24 @@ class RffGradPenHyper_v2(object):
 
 
     def train_map(self, x, y, n_epochs, learning_rate=0.001, early_stopping=False, tol=1e-4, patience=3, clipvalue=100, batch_size=None, infer_lengthscale=True, infer_prior_w2_sig2=True):
-        x = tf.cast(tf.convert_to_tensor(x), tf.float32)
-        y = tf.cast(tf.convert_to_tensor(y), tf.float32)
+        x = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y = tf.cast(tf.convert_to_tensor(y), self.dtype)
 
         hyperparam_hist = {}
         
         # starting values
-        w2_map = tf.Variable(np.random.randn(self.dim_hidden,1)/self.dim_hidden, dtype=np.float32)
+        w2_map = tf.Variable(np.random.randn(self.dim_hidden,1)/self.dim_hidden, dtype=self.dtype)
 
 
-        lengthscale_map = tfp.math.softplus_inverse(tf.constant(self.lengthscale, dtype=tf.float32)) # note: _map is untransformed by softplus
+        lengthscale_map = tfp.math.softplus_inverse(tf.constant(self.lengthscale, dtype=self.dtype)) # note: _map is untransformed by softplus
         if infer_lengthscale:
-            lengthscale_map = tf.Variable(lengthscale_map, dtype=np.float32)
+            lengthscale_map = tf.Variable(lengthscale_map, dtype=self.dtype)
             hyperparam_hist['lengthscale'] = [tf.math.softplus(lengthscale_map).numpy()]
             print('lengthscale init: ', hyperparam_hist['lengthscale'][0])
 
-        prior_w2_sig2_map = tfp.math.softplus_inverse(tf.constant(self.prior_w2_sig2, dtype=tf.float32)) # note: _map is untransformed by softplus
+        prior_w2_sig2_map = tfp.math.softplus_inverse(tf.constant(self.prior_w2_sig2, dtype=self.dtype)) # note: _map is untransformed by softplus
         if infer_prior_w2_sig2:
-            prior_w2_sig2_map = tf.Variable(prior_w2_sig2_map, dtype=np.float32)
+            prior_w2_sig2_map = tf.Variable(prior_w2_sig2_map, dtype=self.dtype)
             hyperparam_hist['prior_w2_sig2'] = [tf.math.softplus(prior_w2_sig2_map).numpy()]
             print('lengthscale init: ', hyperparam_hist['prior_w2_sig2'][0])
 
@@ -734,20 +839,28 @@ class RffGradPenHyper_v2(object):
                 unnormalized_log_prob = lambda w2: unnormalized_log_prob_(w2, tf.math.softplus(lengthscale_map), tf.math.softplus(prior_w2_sig2_map)) # use softpluses
                 var_list = [w2_map]
 
-            unnormalized_neg_log_probs.append(lambda: -unnormalized_log_prob(*var_list)) # evaluate on Variables
+            unnormalized_neg_log_probs.append(lambda f=unnormalized_log_prob: -f(*var_list)) # evaluate on Variables
 
-        for epoch in range(n_epochs):
-            for unnormalized_neg_log_prob in unnormalized_neg_log_probs:
-                #opt.minimize(unnormalized_neg_log_prob, var_list=var_list)
-
-                ### if you want to processes the gradients
+        def make_grad_step(unnormalized_neg_log_prob):
+            # one compiled loss + clipped gradients per batch. apply_gradients stays outside the XLA function,
+            # optimizer updates don't compile reliably under jit_compile for every optimizer/device
+            @tf.function(jit_compile=True)
+            def grad_step():
                 with tf.GradientTape() as tape:
                     loss = unnormalized_neg_log_prob()
                 grads = tape.gradient(loss, var_list)
                 grads = [tf.clip_by_norm(g, 500.) for g in grads]
+                return loss, grads
+            return grad_step
+
+        grad_steps = [make_grad_step(f) for f in unnormalized_neg_log_probs]
+
+        for epoch in range(n_epochs):
+            for grad_step in grad_steps:
+                #opt.minimize(unnormalized_neg_log_prob, var_list=var_list)
+                _, grads = grad_step()
                 opt.apply_gradients(zip(grads, var_list))
                 print(tf.math.softplus(lengthscale_map))
-                ###
 
             if infer_lengthscale:
                 hyperparam_hist['lengthscale'].append(tf.math.softplus(lengthscale_map).numpy().item())
@@ -776,31 +889,85 @@ class RffGradPenHyper_v2(object):
         
         return w2, hyperparam_hist
 
+    def train_map_lbfgs(self, x, y, max_iterations=200, tolerance=1e-6, infer_lengthscale=True, infer_prior_w2_sig2=True):
+        '''
+        Full batch MAP estimate with L-BFGS, as an alternative to the SGD loop in train_map.
+        Optimizes [w2, softplus^-1(lengthscale), softplus^-1(prior_w2_sig2)] as one vector.
+        '''
+        x = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y = tf.cast(tf.convert_to_tensor(y), self.dtype)
+
+        unnormalized_log_prob_, _ = self.make_unnormalized_log_prob(x, y, infer_lengthscale=infer_lengthscale)
+
+        # starting values (hyperparameters untransformed by softplus)
+        w2_init = tf.cast(tf.convert_to_tensor(np.random.randn(self.dim_hidden)/self.dim_hidden), self.dtype)
+        lengthscale_raw = tfp.math.softplus_inverse(tf.constant(self.lengthscale, dtype=self.dtype))
+        prior_w2_sig2_raw = tfp.math.softplus_inverse(tf.constant(self.prior_w2_sig2, dtype=self.dtype))
+        start = tf.concat([w2_init, tf.stack([lengthscale_raw, prior_w2_sig2_raw])], 0)
 
-    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3), infer_lengthscale=False, infer_prior_w2_sig2=False, w2_init=None):
+        hyperparam_hist = {}
+        if infer_lengthscale:
+            hyperparam_hist['lengthscale'] = [self.lengthscale]
+        if infer_prior_w2_sig2:
+            hyperparam_hist['prior_w2_sig2'] = [self.prior_w2_sig2]
+
+        def unnormalized_neg_log_prob(params):
+            w2 = tf.reshape(params[:-2], (-1,1))
+            lengthscale = tf.math.softplus(params[-2]) if infer_lengthscale else self.lengthscale
+            prior_w2_sig2 = tf.math.softplus(params[-1]) if infer_prior_w2_sig2 else self.prior_w2_sig2
+            return -unnormalized_log_prob_(w2, lengthscale, prior_w2_sig2)
+
+        @tf.function(jit_compile=True)
+        def loss_and_grad(params):
+            return tfp.math.value_and_gradient(unnormalized_neg_log_prob, params)
+
+        results = tfp.optimizer.lbfgs_minimize(loss_and_grad, initial_position=start, max_iterations=max_iterations, tolerance=tolerance)
+        print('converged: ', results.converged.numpy(), ', iterations: ', results.num_iterations.numpy())
+
+        # unpack
+        params = results.position
+        w2 = tf.reshape(params[:-2], (-1,1))
+        if infer_lengthscale:
+            self.lengthscale = tf.math.softplus(params[-2]).numpy().item()
+            hyperparam_hist['lengthscale'].append(self.lengthscale)
+
+        if infer_prior_w2_sig2:
+            self.prior_w2_sig2 = tf.math.softplus(params[-1]).numpy().item()
+            hyperparam_hist['prior_w2_sig2'].append(self.prior_w2_sig2)
+
+        print('lengthscale final: ', self.lengthscale)
+        print('prior_w2_sig2 final: ', self.prior_w2_sig2)
+
+        return w2, hyperparam_hist
+
+
+    def train(self, x, y, num_results = int(10e3), num_burnin_steps = int(1e3), infer_lengthscale=False, infer_prior_w2_sig2=False, w2_init=None, precondition=False, sampler='hmc'):
         '''
+        precondition: use h^Th/noise_sig2 + I/prior_w2_sig2 (at the initial hyperparameters) as the mass matrix for w2.
+                      Inferred hyperparameters are not preconditioned. Only used for gaussian family.
+        sampler: 'hmc' or 'nuts' (see bnn.inference.mcmc.hmc_tf)
         '''
-        x = tf.cast(tf.convert_to_tensor(x), tf.float32)
-        y = tf.cast(tf.convert_to_tensor(y), tf.float32)
+        x = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y = tf.cast(tf.convert_to_tensor(y), self.dtype)
 
         # initialize w2 randomly or to MAP
         if w2_init is None:
-            w2_init = tf.cast(tf.convert_to_tensor(np.random.randn(self.dim_hidden,1)/self.dim_hidden), tf.float32)
+            w2_init = tf.cast(tf.convert_to_tensor(np.random.randn(self.dim_hidden,1)/self.dim_hidden), self.dtype)
 
         # set up objective and initialization depending if variational parameters inferred
         unnormalized_log_prob_, _ = self.make_unnormalized_log_prob(x, y, infer_lengthscale=infer_lengthscale)
 
         if infer_lengthscale and infer_prior_w2_sig2:
             unnormalized_log_prob = lambda w2, lengthscale, prior_w2_sig2: unnormalized_log_prob_(w2, lengthscale, prior_w2_sig2) 
-            init_values = [w2_init, tf.constant(self.lengthscale, dtype=tf.float32), tf.constant(self.prior_w2_sig2, dtype=tf.float32)]
+            init_values = [w2_init, tf.constant(self.lengthscale, dtype=self.dtype), tf.constant(self.prior_w2_sig2, dtype=self.dtype)]
 
         elif infer_lengthscale and (not infer_prior_w2_sig2):
             unnormalized_log_prob = lambda w2, lengthscale: unnormalized_log_prob_(w2, lengthscale, self.prior_w2_sig2)
-            init_values = [w2_init, tf.constant(self.lengthscale, dtype=tf.float32)]
+            init_values = [w2_init, tf.constant(self.lengthscale, dtype=self.dtype)]
 
         elif (not infer_lengthscale) and infer_prior_w2_sig2:
             unnormalized_log_prob = lambda w2, prior_w2_sig2: unnormalized_log_prob_(w2, self.lengthscale, prior_w2_sig2)
-            init_values = [w2_init, tf.constant(self.prior_w2_sig2, dtype=tf.float32)]
+            init_values = [w2_init, tf.constant(self.prior_w2_sig2, dtype=self.dtype)]
 
         else:
             unnormalized_log_prob = lambda w2: unnormalized_log_prob_(w2, self.lengthscale, self.prior_w2_sig2)
@@ -811,12 +978,21 @@ class RffGradPenHyper_v2(object):
         #unnormalized_log_prob(w2_init)
         ###
 
+        momentum_distribution = None
+        if precondition and self.family == 'gaussian':
+            h = self.hidden_features(x, lengthscale=self.lengthscale)
+            HtH = tf.matmul(h, h, transpose_a=True)
+            precision = HtH/self.noise_sig2 + tf.eye(self.dim_hidden, dtype=self.dtype)/self.prior_w2_sig2
+            momentum_distribution = bnn.inference.mcmc.momentum_from_precision(precision, n_hyper=int(infer_lengthscale) + int(infer_prior_w2_sig2))
+
         samples, accept = bnn.inference.mcmc.hmc_tf(unnormalized_log_prob, 
             init_values, 
             num_results, 
             num_burnin_steps, 
             num_leapfrog_steps=3, 
-            step_size=1.)
+            step_size=1.,
+            momentum_distribution=momentum_distribution,
+            sampler=sampler)
 
         return samples, accept
 
@@ -828,15 +1004,15 @@ class RffGradPenHyper_v2(object):
         assert self.penalty_type == 'l2'
         #assert np.all([s==self.scale_global[0] for s in self.scale_global]) # only works if all scales are the same (easy to adapt if not though)
         
-        x = tf.cast(tf.convert_to_tensor(x), tf.float32)
-        y = tf.cast(tf.convert_to_tensor(y), tf.float32)
+        x = tf.cast(tf.convert_to_tensor(x), self.dtype)
+        y = tf.cast(tf.convert_to_tensor(y), self.dtype)
 
         h = self.hidden_features(x, lengthscale=self.lengthscale)
         Ax_d = self.grad_norm(x, lengthscale=self.lengthscale)
         Ax_d = [s*A for s,A in zip(self.scale_global, Ax_d)] # multiply by scale
         Ax = tf.reduce_sum(tf.stack(Ax_d),0) # sum over input dimension
 
-        prior_sig2inv_mat = 1/self.prior_w2_sig2*tf.eye(self.dim_hidden) + Ax # prior includes gradient penalty
+        prior_sig2inv_mat = 1/self.prior_w2_sig2*tf.eye(self.dim_hidden, dtype=self.dtype) + Ax # prior includes gradient penalty
         sig2 = tf.linalg.inv(prior_sig2inv_mat + tf.transpose(h)@(h)/self.noise_sig2) # Should replace with cholesky
         mu = sig2 @ tf.transpose(h)@y/self.noise_sig2
 
@@ -888,7 +1064,8 @@ class RffGradPenHyper_v3(object):
         self.scale_global = tf.reshape(tf.cast(tf.convert_to_tensor(scale_global), self.dtype), -1)
 
         self.sample_features()
-        self.act = lambda z: sqrt(2/self.dim_hidden)*tf.math.cos(z)
+        self._rff_scale = tf.constant(sqrt(2/self.dim_hidden), dtype=self.dtype) # RFF output scaling
+        self.act = lambda z: self._rff_scale*tf.math.cos(z)
 
     def sample_features(self):
         # sample random weights for RFF features
@@ -925,12 +1102,12 @@ class RffGradPenHyper_v3(object):
             xw1 = self.compute_xw1(x, lengthscale=None)
         if lengthscale is None:
             lengthscale = self.lengthscale
-        return -sqrt(2/self.dim_hidden) * tf.expand_dims(self.w1 / tf.expand_dims(lengthscale, 0), 0) * tf.expand_dims(tf.math.sin(xw1 + tf.reshape(self.b1, (1,-1))), -1) # analytical jacobian
+        return -self._rff_scale * tf.expand_dims(self.w1 / tf.expand_dims(lengthscale, 0), 0) * tf.expand_dims(tf.math.sin(xw1 + tf.reshape(self.b1, (1,-1))), -1) # analytical jacobian
 
     def grad_norm(self, x=None, xw1=None, lengthscale=None):
         J = self.jacobian_hidden_features(x=x, xw1=xw1, lengthscale=lengthscale)
-        Ax_d = [1/J.shape[0]*tf.transpose(J[:,:,d])@J[:,:,d] for d in range(self.dim_in)]
-        return Ax_d # list of length D, each element is K x K
+        Ax_d = tf.einsum('nkd,nmd->dkm', J, J) / J.shape[0]
+        return Ax_d # D x K x K
 
     def make_log_marginal_likelihood(self):
 
@@ -944,9 +1121,9 @@ class RffGradPenHyper_v3(object):
             h = self.hidden_features(x=x, xw1=None, lengthscale=lengthscale)
 
             # gradients
-            Ax_d = self.grad_norm(x, lengthscale=lengthscale) # list of length D, each element is K x K
-            Ax_d = tf.stack(Ax_d) * tf.reshape(scale_global,(-1,1,1)) # (D, K, K)
-            Ax = tf.reduce_sum(tf.stack(Ax_d),0) # sum over input dimension
+            Ax_d = self.grad_norm(x, lengthscale=lengthscale) # (D, K, K)
+            Ax_d = Ax_d * tf.reshape(scale_global,(-1,1,1)) # (D, K, K)
+            Ax = tf.reduce_sum(Ax_d,0) # sum over input dimension
 
             # inverse of prior covariance of w2
             if self.prior_w2_sig2.shape[0]==1:
@@ -1051,10 +1228,9 @@ class RffGradPenHyper_v3(object):
         y = tf.cast(tf.convert_to_tensor(y), tf.float32)
 
         h = self.hidden_features(x, lengthscale=self.lengthscale)
-        Ax_d = self.grad_norm(x, lengthscale=self.lengthscale) # (N, K, D)
-        #Ax_d = Ax_d * tf.expand_dims(self.scale_global,(0,1)) # multiply by scale (N, K, D)
-        Ax_d = [s*A for s,A in zip(self.scale_global, Ax_d)] # multiply by scale (N, K, D)
-        Ax = tf.reduce_sum(tf.stack(Ax_d),0) # sum over input dimension
+        Ax_d = self.grad_norm(x, lengthscale=self.lengthscale) # (D, K, K)
+        Ax_d = Ax_d * tf.reshape(self.scale_global,(-1,1,1)) # multiply by scale (D, K, K)
+        Ax = tf.reduce_sum(Ax_d,0) # sum over input dimension
 
         if self.prior_w2_sig2.shape[0]==1:
             prior_sig2inv_mat = tf.eye(self.dim_hidden)/self.prior_w2_sig2
@@ -1075,6 +1251,46 @@ class RffGradPenHyper_v3(object):
 
 
 
+def _snapshot_init(model):
+    '''
+    Everything init_parameters leaves behind, so reinit_parameters can restore a candidate without re-running it:
+    the state_dict, plain tensor attributes of the submodules that aren't registered as buffers (e.g. stored samples),
+    and the torch/numpy rng states
+    '''
+    attrs = [{k: copy.deepcopy(v) for k, v in m.__dict__.items() if torch.is_tensor(v)} for m in model.modules()]
+    rng_cuda = torch.cuda.get_rng_state_all() if torch.cuda.is_initialized() else None
+    return copy.deepcopy(model.state_dict()), attrs, torch.get_rng_state(), rng_cuda, np.random.get_state()
+
+
+def _restore_init(model, snapshot):
+    state_dict, attrs, rng_cpu, rng_cuda, rng_np = snapshot
+    model.load_state_dict(state_dict) # in place, so parameters already handed to an optimizer stay valid
+    for m, attrs_m in zip(model.modules(), attrs):
+        m.__dict__.update(attrs_m)
+    torch.set_rng_state(rng_cpu)
+    if rng_cuda is not None:
+        torch.cuda.set_rng_state_all(rng_cuda)
+    np.random.set_state(rng_np)
+
+
+def update_noise_precision(sig2_inv_alpha_prior, sig2_inv_beta_prior, SSR, n_obs, temperature=1, alpha_cache=None):
+    '''
+    Conjugate gamma update of the noise precision given the sum of squared residuals.
+    No model state, returns (sig2_inv_alpha, sig2_inv_beta)
+
+    alpha_cache: optional dict reused across calls. alpha doesn't depend on the residuals, so it's only computed once per (temperature, n_obs)
+    '''
+    key = (float(temperature), n_obs)
+    if alpha_cache is not None and key in alpha_cache:
+        sig2_inv_alpha = alpha_cache[key].clone() # clone so the caller can update its copy in place
+    else:
+        sig2_inv_alpha = sig2_inv_alpha_prior + temperature*0.5*n_obs
+        if alpha_cache is not None:
+            alpha_cache[key] = sig2_inv_alpha.clone()
+    sig2_inv_beta = sig2_inv_beta_prior + temperature*0.5*SSR
+    return sig2_inv_alpha, sig2_inv_beta
+
+
 class RffHs(nn.Module):
     """
     RFF model with horseshoe
@@ -1111,6 +1327,8 @@ class RffHs(nn.Module):
 
             self.register_buffer('sig2_inv', torch.tensor(sig2_inv).clone().detach())
 
+        self._alpha_cache = {} # for update_noise_precision
+
         # layers
         #self.layer_in = layers.RffHsLayer2(self.dim_in, self.dim_hidden, **kwargs)
         #self.layer_in = layers.RffLogitNormalLayer(self.dim_in, self.dim_hidden, **kwargs)
@@ -1162,8 +1380,15 @@ class RffHs(nn.Module):
 
         averages over n_pred (e.g. could represent different samples), sums over n_obs
         '''
-        lik = Normal(y_pred, torch.sqrt(1/self.sig2_inv))
-        return lik.log_prob(y_observed.unsqueeze(1)).mean(1).sum(0)
+        # gaussian log density written out (avoids constructing a Normal each call)
+        # constant terms are pulled out of the mean/sum so only the squared residual is (n_obs, n_pred, dim_out)
+        n_obs = y_observed.shape[0]
+        if y_pred.shape[1] == 1:
+            # single prediction (as in loss), so skip the broadcast and the mean over n_pred
+            diff = y_observed - y_pred.squeeze(1)
+            return n_obs*(0.5*torch.log(self.sig2_inv) - 0.5*_LOG_2PI) - 0.5*self.sig2_inv*diff.pow(2).sum(0)
+        diff = y_observed.unsqueeze(1) - y_pred
+        return n_obs*(0.5*torch.log(self.sig2_inv) - 0.5*_LOG_2PI) - 0.5*self.sig2_inv*diff.pow(2).mean(1).sum(0)
 
     def loss_original(self, x, y, x_linear=None, temperature=1, n_samp=1):
         '''negative elbo'''
@@ -1194,8 +1419,8 @@ class RffHs(nn.Module):
         self.layer_out.fixed_point_updates(h, y) # conjugate update of output weights 
         self.layer_out.sample_weights(store=True)
 
-        # 4: forward pass of test data using samples from 1 and 3
-        y_pred = self.forward(x, weights_type_layer_in='stored', weights_type_layer_out='stored', n_samp_layer_in=1)
+        # 4: output layer on the hidden units from 2 (same stored weights, so no need to redo layer_in)
+        y_pred = self.layer_out(h, weights_type='stored').unsqueeze(1) # (n_obs, 1, dim_out)
 
         log_prob = self.log_prob(y, y_pred)
 
@@ -1213,23 +1438,27 @@ class RffHs(nn.Module):
         """
         ####
 
+        # one bnn sample shared by the linear term and noise updates
+        if self.linear_term or (self.infer_noise and temperature > 0):
+            sample_y_bnn = self.forward(x, x_linear=None, sample=True) # Sample
+
         if self.linear_term:
             if self.infer_noise:
                 self.blm.sig2_inv = self.sig2_inv_alpha/self.sig2_inv_beta # Shouldnt this be a samplle?
             
-            self.blm.fixed_point_updates(y - self.forward(x, x_linear=None, sample=True)) # Subtract off just the bnn
+            self.blm.fixed_point_updates(y - sample_y_bnn) # Subtract off just the bnn
 
         if self.infer_noise and temperature > 0: 
             
-            sample_y_bnn = self.forward(x, x_linear=None, sample=True) # Sample
             if self.linear_term:
                 E_y_linear = F.linear(x_linear, self.blm.beta_mu)
-                SSR = torch.sum((y-sample_y_bnn-E_y_linear)**2) + torch.sum(self.blm.xx_inv * self.blm.beta_sig2).sum()
+                resid = y.sub(sample_y_bnn)
+                resid.sub_(E_y_linear)
+                SSR = resid.pow_(2).sum().add_(torch.sum(self.blm.xx_inv * self.blm.beta_sig2))
             else:
-                SSR = torch.sum((y - sample_y_bnn)**2)
+                SSR = y.sub(sample_y_bnn).pow_(2).sum()
 
-            self.sig2_inv_alpha = self.sig2_inv_alpha_prior + temperature*0.5*x.shape[0] # Can be precomputed
-            self.sig2_inv_beta = self.sig2_inv_beta_prior + temperature*0.5*SSR
+            self.sig2_inv_alpha, self.sig2_inv_beta = update_noise_precision(self.sig2_inv_alpha_prior, self.sig2_inv_beta_prior, SSR, x.shape[0], temperature, alpha_cache=self._alpha_cache)
 
     def init_parameters(self, seed=None):
         if seed is not None:
@@ -1246,13 +1475,20 @@ class RffHs(nn.Module):
             self.blm.init_parameters()
 
     def reinit_parameters(self, x, y, n_reinit=1):
-        seeds = torch.zeros(n_reinit).long().random_(0, 1000)
-        losses = torch.zeros(n_reinit)
-        for i in range(n_reinit):
-            self.init_parameters(seeds[i])
-            losses[i] = self.loss(x, y)
-
-        self.init_parameters(seeds[torch.argmin(losses).item()])
+        # drawn up front from numpy so init_parameters reseeding torch doesn't affect the candidate seeds
+        seeds = np.random.default_rng().integers(0, 1000, size=n_reinit).tolist()
+        with torch.no_grad(): # losses are only compared, no need to build graphs
+            for i in range(n_reinit):
+                self.init_parameters(seeds[i])
+                snapshot = _snapshot_init(self) # before loss updates the output layer
+                loss = self.loss(x, y).item()
+                if i == 0 or loss < loss_best:
+                    loss_best = loss
+                    snapshot_best = snapshot
+
+        # restore the best initialization instead of re-running init_parameters
+        # (same end state as init_parameters(best seed), including the rng)
+        _restore_init(self, snapshot_best)
 
     def precompute(self, x=None, x_linear=None):
         # Needs to be run before training
@@ -1308,6 +1544,8 @@ class RffBeta(nn.Module):
 
             self.register_buffer('sig2_inv', torch.tensor(sig2_inv).clone().detach())
 
+        self._alpha_cache = {} # for update_noise_precision
+
         # layers
         self.layer_in = layers.RffBetaLayer(self.dim_in, self.dim_hidden, **kwargs)
         self.layer_out = layers.LinearLayer(self.dim_hidden, sig2_y=1/sig2_inv, **kwargs)
@@ -1327,7 +1565,17 @@ class RffBeta(nn.Module):
     def kl_divergence(self):
         return self.layer_in.kl_divergence()
 
-    def compute_loss_gradients(self, x, y, x_linear=None, temperature=1.):
+    def compute_loss_gradients(self, x, y, x_linear=None, temperature=1., scale=1.):
+        '''
+        Score function estimate of the gradient of -elbo, times scale.
+        Added to whatever is already in .grad of s_a_trans and s_b_trans, so estimates can be accumulated over calls.
+
+        Returns the (detached) single sample estimate of -elbo used for the gradient.
+        '''
+
+        # gradients accumulated so far (the backward passes below need .grad cleared)
+        grad_a_prev = self.layer_in.s_a_trans.grad.clone() if self.layer_in.s_a_trans.grad is not None else None
+        grad_b_prev = self.layer_in.s_b_trans.grad.clone() if self.layer_in.s_b_trans.grad is not None else None
 
         # sample from variational dist
         self.layer_in.sample_variational(store=True)
@@ -1358,8 +1606,12 @@ class RffBeta(nn.Module):
 
         # gradients of loss=-elbo
         with torch.no_grad():
-            self.layer_in.s_a_trans.grad = -log_lik*self.layer_in.s_a_trans_grad_q + temperature*self.layer_in.s_a_trans_grad_kl
-            self.layer_in.s_b_trans.grad = -log_lik*self.layer_in.s_b_trans_grad_q + temperature*self.layer_in.s_b_trans_grad_kl
+            grad_a = scale*(-log_lik*self.layer_in.s_a_trans_grad_q + temperature*self.layer_in.s_a_trans_grad_kl)
+            grad_b = scale*(-log_lik*self.layer_in.s_b_trans_grad_q + temperature*self.layer_in.s_b_trans_grad_kl)
+            self.layer_in.s_a_trans.grad = grad_a if grad_a_prev is None else grad_a_prev.add_(grad_a)
+            self.layer_in.s_b_trans.grad = grad_b if grad_b_prev is None else grad_b_prev.add_(grad_b)
+
+        return (-log_lik + temperature*kl).detach()
 
     def loss(self, x, y, x_linear=None, temperature=1):
         '''negative elbo
@@ -1381,7 +1633,7 @@ class RffBeta(nn.Module):
             sig2_inv = self.sig2_inv_alpha/self.sig2_inv_beta # Is this right? i.e. IG vs G
         else:
             sig2_inv = self.sig2_inv
-        log_prob = -0.5 * N * math.log(2 * math.pi) + 0.5 * N * torch.log(sig2_inv) - 0.5 * torch.sum((y_observed - y_pred)**2) * sig2_inv
+        log_prob = -0.5 * N * _LOG_2PI + 0.5 * N * torch.log(sig2_inv) - 0.5 * torch.sum((y_observed - y_pred)**2) * sig2_inv
         return -log_prob
 
     def fixed_point_updates(self, x, y, x_linear=None, temperature=1): 
@@ -1391,23 +1643,27 @@ class RffBeta(nn.Module):
 
         self.layer_out.sample_weights(store=True) # sample output weights from full conditional
 
+        # one bnn sample shared by the linear term and noise updates
+        if self.linear_term or (self.infer_noise and temperature > 0):
+            sample_y_bnn = self.forward(x, x_linear=None, sample=True) # Sample
+
         if self.linear_term:
             if self.infer_noise:
                 self.blm.sig2_inv = self.sig2_inv_alpha/self.sig2_inv_beta # Shouldnt this be a samplle?
             
-            self.blm.fixed_point_updates(y - self.forward(x, x_linear=None, sample=True)) # Subtract off just the bnn
+            self.blm.fixed_point_updates(y - sample_y_bnn) # Subtract off just the bnn
 
         if self.infer_noise and temperature > 0: 
             
-            sample_y_bnn = self.forward(x, x_linear=None, sample=True) # Sample
             if self.linear_term:
                 E_y_linear = F.linear(x_linear, self.blm.beta_mu)
-                SSR = torch.sum((y-sample_y_bnn-E_y_linear)**2) + torch.sum(self.blm.xx_inv * self.blm.beta_sig2).sum()
+                resid = y.sub(sample_y_bnn)
+                resid.sub_(E_y_linear)
+                SSR = resid.pow_(2).sum().add_(torch.sum(self.blm.xx_inv * self.blm.beta_sig2))
             else:
-                SSR = torch.sum((y - sample_y_bnn)**2)
+                SSR = y.sub(sample_y_bnn).pow_(2).sum()
 
-            self.sig2_inv_alpha = self.sig2_inv_alpha_prior + temperature*0.5*x.shape[0] # Can be precomputed
-            self.sig2_inv_beta = self.sig2_inv_beta_prior + temperature*0.5*SSR
+            self.sig2_inv_alpha, self.sig2_inv_beta = update_noise_precision(self.sig2_inv_alpha_prior, self.sig2_inv_beta_prior, SSR, x.shape[0], temperature, alpha_cache=self._alpha_cache)
 
     def init_parameters(self, seed=None):
         if seed is not None:
@@ -1424,13 +1680,20 @@ class RffBeta(nn.Module):
             self.blm.init_parameters()
 
     def reinit_parameters(self, x, y, n_reinit=1):
-        seeds = torch.zeros(n_reinit).long().random_(0, 1000)
-        losses = torch.zeros(n_reinit)
-        for i in range(n_reinit):
-            self.init_parameters(seeds[i])
-            losses[i] = self.loss(x, y)
-
-        self.init_parameters(seeds[torch.argmin(losses).item()])
+        # drawn up front from numpy so init_parameters reseeding torch doesn't affect the candidate seeds
+        seeds = np.random.default_rng().integers(0, 1000, size=n_reinit).tolist()
+        with torch.no_grad(): # losses are only compared, no need to build graphs
+            for i in range(n_reinit):
+                self.init_parameters(seeds[i])
+                snapshot = _snapshot_init(self) # before loss updates the output layer
+                loss = self.loss(x, y).item()
+                if i == 0 or loss < loss_best:
+                    loss_best = loss
+                    snapshot_best = snapshot
+
+        # restore the best initialization instead of re-running init_parameters
+        # (same end state as init_parameters(best seed), including the rng)
+        _restore_init(self, snapshot_best)
 
     def precompute(self, x=None, x_linear=None):
         # Needs to be run before training
@@ -1449,134 +1712,3 @@ class RffBeta(nn.Module):
         '''
         print('Epoch[{}/{}], kl: {:.6f}, likelihood: {:.6f}, elbo: {:.6f}'\
                         .format(epoch, n_epochs, self.kl_divergence().item(), -self.loss(x,y,temperature=0).item(), -self.loss(x,y).item()))
-
-
-
-
-def train(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n_rep_opt=10, print_freq=None, frac_start_save=1, frac_lookback=0.5, path_checkpoint='./'):
-    '''
-    frac_lookback will only result in reloading early stopped model if frac_lookback < 1 - frac_start_save
-    '''
-
-    loss = torch.zeros(n_epochs)
-    loss_best = torch.tensor(float('inf'))
-    loss_best_saved = torch.tensor(float('inf'))
-    saved_model = False
-    model.precompute(x, x_linear)
-
-    for epoch in range(n_epochs):
-
-        # TEMPERATURE HARDECODED, NEED TO FIX
-        #temperature_kl = 0. if epoch < n_epochs/2 else 1.0
-        #temperature_kl = epoch / (n_epochs/2) if epoch < n_epochs/2 else 1.0
-        temperature_kl = epoch / (n_epochs/10) if epoch < n_epochs/10 else 1.0
-        #temperature_kl = 0. # SET TO ZERO TO IGNORE KL
-
-        for i in range(n_rep_opt):
-
-            l = model.loss(x, y, x_linear=x_linear, temperature=temperature_kl)
-
-            # backward
-            optimizer.zero_grad()
-            l.backward(retain_graph=True)
-            optimizer.step()
-
-            ##
-            #print('------------- %d -------------' % epoch)
-            #print('s     :', model.layer_in.s_loc.data)
-            #print('grad  :', model.layer_in.s_loc.grad)
-
-            #model.layer_in.s_loc.grad.zero_()
-            #kl = model.layer_in.kl_divergence()
-            #kl.backward()
-            #if epoch > 500:
-            #    breakpoint()
-            #print('grad kl:', model.layer_in.s_loc.grad)
-            ##
-
-        loss[epoch] = l.item()
-
-        with torch.no_grad():
-            model.fixed_point_updates(x, y, x_linear=x_linear, temperature=1)
-
-        # print state
-        if print_freq is not None:
-            if (epoch + 1) % print_freq == 0:
-                model.print_state(x, y, epoch+1, n_epochs)
-
-        # see if improvement made (only used if KL isn't tempered)
-        if loss[epoch] < loss_best and temperature_kl==1.0:
-            loss_best = loss[epoch]
-
-        # save model
-        if epoch > frac_start_save*n_epochs and loss[epoch] < loss_best_saved:
-            print('saving mode at epoch = %d' % epoch)
-            saved_model = True
-            loss_best_saved = loss[epoch]
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'loss': loss[epoch],
-            },  os.path.join(path_checkpoint, 'checkpoint.tar'))
-
-        # end training if no improvement made in a while and more than half way done
-        epoch_lookback = np.maximum(1, int(epoch - .25*n_epochs)) # lookback is 25% of samples by default
-        if epoch_lookback > frac_start_save*n_epochs+1:
-            loss_best_lookback = torch.min(loss[epoch_lookback:epoch+1])
-            percent_improvement = (loss_best - loss_best_lookback)/torch.abs(loss_best) # positive is better
-            if percent_improvement < 0.0:
-                print('stopping early at epoch = %d' % epoch)
-                break
-
-    # reload best model if saving
-    if saved_model:
-        checkpoint = torch.load(os.path.join(path_checkpoint, 'checkpoint.tar'))
-        model.load_state_dict(checkpoint['model_state_dict'])
-        print('reloading best model from epoch = %d' % checkpoint['epoch'])
-        model.eval()
-
-
-    return loss[:epoch]
-
-
-def train_score(model, optimizer, x, y, n_epochs, x_linear=None, n_warmup = 0, n_rep_opt=10, print_freq=None, frac_start_save=1):
-    loss = torch.zeros(n_epochs)
-    loss_best = 1e9 # Need better way of initializing to make sure it's big enough
-    model.precompute(x, x_linear)
-
-    for epoch in range(n_epochs):
-
-        # TEMPERATURE HARDECODED, NEED TO FIX
-        #temperature_kl = 0. if epoch < n_epochs/2 else 1
-        #temperature_kl = epoch / (n_epochs/2) if epoch < n_epochs/2 else 1
-        temperature_kl = 0. # SET TO ZERO TO IGNORE KL
-
-        for i in range(n_rep_opt):
-
-            optimizer.zero_grad()
-
-            model.compute_loss_gradients(x, y, x_linear=x_linear, temperature=temperature_kl)
-
-            # backward
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 100)
-            optimizer.step()
-
-        with torch.no_grad():
-            model.fixed_point_updates(x, y, x_linear=x_linear, temperature=1)
-
-        if epoch > frac_start_save*n_epochs and loss[epoch] < loss_best: 
-            print('saving...')
-            loss_best = loss[epoch]
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'loss': loss[epoch],
-            }, 'checkpoint.tar')
-
-        if print_freq is not None:
-            if (epoch + 1) % print_freq == 0:
-                model.print_state(x, y, epoch+1, n_epochs)
-
-    return loss
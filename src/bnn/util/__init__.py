@@ -1,4 +1,5 @@
 from . import misc # equivalently can do asbolute "import bnn.util.misc"
 from . import callbacks
 from . import distributions
-from . import plotting
\ No newline at end of file
+from . import plotting
+from . import training
@@ -0,0 +1,66 @@
+# standard library imports
+import io
+import copy
+
+# package imports
+import torch
+
+
+def stage_state_dict(state_dict, staged=None):
+    '''
+    Snapshot of a state_dict on the cpu, so it can be written out while training keeps updating the live tensors.
+    cuda tensors go to pinned buffers with non-blocking copies, synchronized once at the end.
+
+    staged: snapshot returned by a previous call, reused as the destination so buffers aren't reallocated every save
+            (the caller must make sure the previous write has finished)
+    '''
+    if staged is None or staged.keys() != state_dict.keys():
+        staged = {}
+    for k, v in state_dict.items():
+        if k not in staged or staged[k].shape != v.shape or staged[k].dtype != v.dtype:
+            staged[k] = torch.empty(v.shape, dtype=v.dtype, pin_memory=v.is_cuda)
+        staged[k].copy_(v.detach(), non_blocking=v.is_cuda)
+    if any(v.is_cuda for v in state_dict.values()):
+        torch.cuda.synchronize()
+    return staged
+
+
+def save_checkpoint(checkpoint, path):
+    '''
+    Serializes to memory first so the file gets one sequential write instead of many small ones
+    '''
+    buf = io.BytesIO()
+    torch.save(checkpoint, buf)
+    with open(path, 'wb') as f:
+        f.write(buf.getbuffer())
+
+
+def checkpoint_async(io_exec, save_future, staged, model, optimizer, epoch, loss_epoch, path):
+    '''
+    Snapshots the model and optimizer state and hands the write to io_exec.
+    Waits for the previous write (save_future) first, so only one is in flight and staged can be reused.
+
+    Returns the future for the new write and the staged model snapshot
+    '''
+    if save_future is not None:
+        save_future.result()
+    staged = stage_state_dict(model.state_dict(), staged)
+    save_future = io_exec.submit(save_checkpoint, {
+        'epoch': epoch,
+        'model_state_dict': staged,
+        'optimizer_state_dict': copy.deepcopy(optimizer.state_dict()),
+        'loss': loss_epoch,
+    }, path)
+    return save_future, staged
+
+
+def update_window_min(window_min, epoch, loss_epoch, epoch_lookback):
+    '''
+    Running min of the loss over epochs [epoch_lookback, epoch], for the early stopping check in bnn.inference.mcmc.train.
+    window_min is a deque of (epoch, loss) pairs with increasing loss, so its front is the min; call once per epoch.
+    '''
+    while window_min and window_min[-1][1] >= loss_epoch:
+        window_min.pop()
+    window_min.append((epoch, loss_epoch))
+    while window_min and window_min[0][0] < epoch_lookback:
+        window_min.popleft()
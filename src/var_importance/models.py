@@ -596,12 +596,12 @@ class BKMRVarImportance(object):
         return self.samples[np.random.choice(self.samples.shape[0]), :].reshape(-1,1)
 
 class BayesLinearLassoVarImportance(object):
-    def __init__(self, X, Y, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None):
+    def __init__(self, X, Y, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, dtype=tf.float64):
         super().__init__()
 
         self.X = torch.from_numpy(X)
         self.Y = torch.from_numpy(Y)
-        self.model = networks.sparse.BayesLinearLasso(dim_in=X.shape[1], dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups)
+        self.model = networks.sparse.BayesLinearLasso(dim_in=X.shape[1], dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, dtype=dtype)
 
     def train(self, num_results = int(10e3), num_burnin_steps = int(1e3)):
         '''
@@ -627,12 +627,12 @@ class BayesLinearLassoVarImportance(object):
 
 
 class RffGradPenVarImportance(object):
-    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1'):
+    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', dtype=tf.float64):
         super().__init__()
 
         self.X = torch.from_numpy(X)
         self.Y = torch.from_numpy(Y)
-        self.model = networks.sparse.RffGradPen(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type)
+        self.model = networks.sparse.RffGradPen(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type, dtype=dtype)
 
     def train(self, num_results = int(10e3), num_burnin_steps = int(1e3)):
         '''
@@ -667,12 +667,12 @@ class RffGradPenVarImportance(object):
 
 
 class RffGradPenVarImportanceHyper(object):
-    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1'):
+    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', dtype=tf.float64):
         super().__init__()
 
         self.X = torch.from_numpy(X)
         self.Y = torch.from_numpy(Y)
-        self.model = networks.sparse.RffGradPenHyper(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type)
+        self.model = networks.sparse.RffGradPenHyper(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type, dtype=dtype)
 
     def train(self, num_results = int(10e3), num_burnin_steps = int(1e3)):
         '''
@@ -705,10 +705,9 @@ class RffGradPenVarImportanceHyper(object):
             #J = -sqrt(2/self.model.dim_hidden) * self.model.w.unsqueeze(0) / l * tf.expand_dims(tf.math.sin(x_w_tf / l + tf.reshape(self.b_tf, (1,-1))), -1) # analytical jacobian
             #J = J.numpy()
 
-            Ax_d = [1/n*J[:,:,d].T@J[:,:,d] for d in range(self.model.dim_in)]
+            Ax_d = np.einsum('nkd,nmd->dkm', J, J) / n # (D, K, K), all input dimensions at once
 
-            for d in range(X.shape[1]):
-                psi[s,d] = w.reshape(1,-1)@Ax_d[d]@w.reshape(-1,1) 
+            psi[s,:] = np.einsum('k,dkm,m->d', w.reshape(-1), Ax_d, w.reshape(-1))
 
         return np.mean(psi,0), np.var(psi,0)
 
@@ -723,12 +722,12 @@ class RffGradPenVarImportanceHyper(object):
 
 
 class RffGradPenVarImportanceHyper_v2(object):
-    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', family='gaussian'):
+    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', family='gaussian', dtype=tf.float32):
         super().__init__()
 
         self.X = torch.from_numpy(X)
         self.Y = torch.from_numpy(Y)
-        self.model = networks.sparse.RffGradPenHyper_v2(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type, family=family)
+        self.model = networks.sparse.RffGradPenHyper_v2(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type, family=family, dtype=dtype)
 
 
     def train(self, num_results = int(10e3), num_burnin_steps = int(1e3), infer_lengthscale=False, infer_prior_w2_sig2=False, w2_init=None):
@@ -803,11 +802,11 @@ class RffGradPenVarImportanceHyper_v2(object):
 
 
 class RffGradPenVarImportanceHyper_v3(object):
-    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', family='gaussian'):
+    def __init__(self, X, Y, dim_hidden=50, prior_w2_sig2=1.0, noise_sig2=1.0, scale_global=1.0, groups=None, scale_groups=None, lengthscale=1.0, penalty_type='l1', family='gaussian', dtype=tf.float32):
         super().__init__()
         self.X = X
         self.Y = Y
-        self.model = networks.sparse.RffGradPenHyper_v3(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type, family=family)
+        self.model = networks.sparse.RffGradPenHyper_v3(dim_in=X.shape[1], dim_hidden=dim_hidden, dim_out=Y.shape[1], prior_w2_sig2=prior_w2_sig2, noise_sig2=noise_sig2, scale_global=scale_global, groups=groups, scale_groups=scale_groups, lengthscale=lengthscale, penalty_type=penalty_type, family=family, dtype=dtype)
 
     def train(self, n_epochs=100, learning_rate=0.001, batch_size=None, opt_lengthscale=True, opt_prior_w2_sig2=True, opt_scale_global=True):
         return self.model.train_log_marginal_likelihood(self.X, self.Y, n_epochs=n_epochs, learning_rate=learning_rate, clipvalue=100, batch_size=batch_size, opt_lengthscale=opt_lengthscale, opt_prior_w2_sig2=opt_prior_w2_sig2, opt_scale_global=opt_scale_global)